@@ -8,61 +8,287 @@ For AIPs over 20 GB, this version of the script is too slow. Instead, use the "n
 # Script usage: python /path/aptrust_aip.py /path/aips_directory
 
 import bagit
+import concurrent.futures
+import contextlib
 import csv
 import datetime
+import hashlib
+import mmap
+import multiprocessing.pool
 import os
 import platform
 import re
+import shutil
 import subprocess
 import sys
+import tarfile
+import time
+import types
 import xml.etree.ElementTree as et
 
+# If the operating system is Windows, which determines the commands for unzipping, untarring, and tarring AIPs.
+# This is found once when the script starts instead of for each AIP.
+IS_WINDOWS = platform.system() == "Windows"
+
+# Paths to the programs for unpacking AIPs (7-Zip for Windows and tar for Mac/Linux) and tarring AIPs (tar).
+# These are found once when the script starts instead of each time a command is run.
+SEVEN_ZIP = shutil.which("7z")
+TAR = shutil.which("tar")
+
+# Path to a bzip2 program that unzips with all the CPUs (lbzip2 or pbzip2), if one is installed, for Mac/Linux.
+# tar uses it in place of the standard bzip2, which only uses one CPU.
+PARALLEL_BZIP2 = shutil.which("lbzip2") or shutil.which("pbzip2")
+
+# Number of threads for writing files when untarring AIPs, from the optional APTRUST_UNTAR_CONCURRENCY environment
+# variable. If it is not set (0), AIPs are untarred with 7-Zip or tar instead.
+UNTAR_CONCURRENCY = int(os.environ.get("APTRUST_UNTAR_CONCURRENCY", 0))
+
+# Number of AIPs to transform at the same time, each in its own process, from the optional APTRUST_AIP_PROCESSES
+# environment variable. If it is not set (1), AIPs are transformed one at a time.
+AIP_PROCESSES = max(int(os.environ.get("APTRUST_AIP_PROCESSES", 1)), 1)
+
+# If the optional APTRUST_CHECK_ALL_NAMES environment variable is set to 1, the characters of every file and directory
+# name are checked, so the impermissible characters CSV lists every name to fix. If it is not set (0), the characters
+# are only checked until the first impermissible name is found, which is enough to stop processing the AIP.
+CHECK_ALL_NAMES = int(os.environ.get("APTRUST_CHECK_ALL_NAMES", 0)) > 0
+
+# Number of CPUs for each AIP to use for unzipping and calculating checksums, shared between the AIPs that are
+# transformed at the same time so the CPUs are not oversubscribed.
+CPUS_PER_AIP = max((os.cpu_count() or 1) // AIP_PROCESSES, 1)
+
+# APTrust's limit for the size of a bag, 5 TB, in bytes.
+BAG_SIZE_LIMIT = 5000000000000
+
+# Characters that are not permitted in file and directory names, with the description used in the error CSV.
+# Made once here instead of each time a name is checked.
+NOT_PERMITTED = {"\n": "newline", "\r": "carriage return", "\t": "tab", "\v": "vertical tab", "\a": "ascii bell"}
+
+# Pattern for the bag name (aip-id_bag) at the start of an AIP file name, compiled once for all AIPs.
+BAG_NAME = re.compile("^(.*_bag).")
+
+# Pattern for the Payload-Oxum line in bag-info.txt, with the payload size in bytes, compiled once for all AIPs.
+PAYLOAD_OXUM = re.compile(rb"^Payload-Oxum\S*\s+(\S+)", re.MULTILINE)
+
+# Namespaces for the elements in the preservation.xml.
+NS = {"dc": "http://purl.org/dc/terms/", "premis": "http://www.loc.gov/premis/v3"}
+
+# Paths to the elements in the preservation.xml with the metadata fields, starting below the root element, with
+# namespaces in the format that ElementTree uses for tags. These are made once when the script starts instead of for
+# every AIP. The aip section is the last one that needs to be read.
+AIP_OBJECT_PATH = ("aip", f"{{{NS['premis']}}}object")
+TITLE_PATH = (f"{{{NS['dc']}}}title",)
+URI_PATH = AIP_OBJECT_PATH + (f"{{{NS['premis']}}}objectIdentifier", f"{{{NS['premis']}}}objectIdentifierType")
+RELATIONSHIP_PATH = AIP_OBJECT_PATH + (f"{{{NS['premis']}}}relationship",)
+COLLECTION_PATH = RELATIONSHIP_PATH + (f"{{{NS['premis']}}}relatedObjectIdentifier",
+                                       f"{{{NS['premis']}}}relatedObjectIdentifierValue")
+
 
 def move_error(error_name, aip_path, aip_name):
     """Moves the AIP to an error folder, named with the error type, so it is clear what step the AIP stopped on.
     Makes the error folder if it does not already exist prior to moving the AIP. """
 
-    if not os.path.exists(f"errors/{error_name}"):
-        os.makedirs(f"errors/{error_name}")
+    os.makedirs(f"errors/{error_name}", exist_ok=True)
     os.replace(aip_path, f"errors/{error_name}/{aip_name}")
 
 
-def unpack(aip_zip):
-    """Unzips (if applicable) and untars the AIP, using different commands for Windows or Mac/Linux. The result is
-    the AIP's bag directory, named aip_path-id_bag, which is saved to a folder named aptrust-aips within the AIPs
-    directory. The original tar and zip files remain in the AIPs directory in case the script needs to be run again. """
+def parallel_untar(tar_path, destination, workers):
+    """Unzips (if applicable) and untars the AIP with Python's tarfile, reading the tar as a stream and writing the
+    files with a pool of threads. On networked storage, where each file takes a round trip to create, this is much
+    faster for AIPs with thousands of small files than untarring one file at a time.
+    Raises tarfile.TarError, subprocess.CalledProcessError, or OSError if the AIP could not be unpacked. """
 
-    # Gets the operating system, which determines the command for unzipping and untarring.
-    operating_system = platform.system()
+    # Files over this size are written by the main thread as they are read, instead of being held in memory.
+    # They are copied in 4 MB pieces, instead of shutil's default of 64 KB (1 MB on Windows), for fewer system calls.
+    max_buffered_size = 64 * 1024 * 1024
+    copy_buffer_size = 4 * 1024 * 1024
 
-    # For Windows, use 7-Zip to extract the files. If the AIP is both tarred and zipped, the command is run twice.
-    if operating_system == "Windows":
+    # Most bytes that can be waiting in memory to be written by the threads, no matter how many threads there are.
+    max_pending_size = 256 * 1024 * 1024
 
-        # Extracts the contents of the zip file, which is a tar file.
-        # Tests if there is a zip file first since some AIPs are just tarred and not zipped.
-        if aip_zip.endswith(".bz2"):
-            subprocess.run(f'7z x {aip_zip}', stdout=subprocess.DEVNULL, shell=True)
-
-        # Extracts the contents of the tar file, which is the AIP's bag directory.
-        # Saves the bag to a folder within the AIPs directory named aptrust-aips.
-        aip_tar = aip_zip.replace(".bz2", "")
-        aip_tar_path = os.path.join(aips_directory, aip_tar)
-        subprocess.run(f'7z x "{aip_tar_path}" -o{os.path.join(aips_directory, "aptrust-aips")}',
-                       stdout=subprocess.DEVNULL, shell=True)
-
-        # Deletes the tar file if there is also a zipped version of the AIP.
-        # This is only necessary for Windows, since in Mac/Linux the intermediate tar file is not saved separately.
-        # Now the AIPs directory only has the original ARCHive AIPs again, plus a folder with the unpacked bags.
+    # The destination folder with any links followed, for testing if paths are within it.
+    real_destination = os.path.realpath(destination)
+
+    # Directories that have already been checked and made, so each one is only checked and made once.
+    made_directories = set()
+
+    def check_path(path):
+        """Raises tarfile.TarError if the path is outside the destination folder once any links in it are followed,
+        for example if the tar has a link to a folder outside the destination followed by a file within that link. """
+
+        real_path = os.path.realpath(path)
+        if real_path != real_destination and not real_path.startswith(os.path.join(real_destination, "")):
+            raise tarfile.TarError(f"Path in tar file is outside the destination: {path}")
+
+    def make_directory(path):
+        """Makes a directory, and any missing parent directories, if it has not already been made,
+        after checking that it is within the destination folder. """
+
+        if path not in made_directories:
+            check_path(path)
+            os.makedirs(path, exist_ok=True)
+            made_directories.add(path)
+
+    def remove_link(path):
+        """Deletes a link that is already at the path, for example from running the script on this AIP before,
+        so a file from the tar replaces it, the same as tar does, instead of being written to where it links. """
+
+        if os.path.islink(path):
+            os.remove(path)
+
+    def write_file(path, content):
+        """Saves the contents of a file from the tar to the file path. """
+
+        with open(path, "wb") as new_file:
+            new_file.write(content)
+
+    def is_unsafe(name):
+        """Tests if a path from the tar would be outside the destination folder. """
+
+        return os.path.isabs(name) or ".." in os.path.normpath(name).replace("\\", "/").split("/")
+
+    # If the AIP is zipped and lbzip2 or pbzip2 is installed, that program unzips it with all the CPUs and the tar is
+    # read from its output, instead of Python unzipping it with one CPU.
+    if tar_path.endswith(".bz2") and PARALLEL_BZIP2:
+        unzip = subprocess.Popen([PARALLEL_BZIP2, "-dc", tar_path], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+        tar_stream = tarfile.open(fileobj=unzip.stdout, mode="r|")
+    else:
+        unzip = None
+        tar_stream = tarfile.open(tar_path, "r|*")
+
+    try:
+        with tar_stream as tar, concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+
+            # Files waiting to be written by the threads, with the number of bytes each one is holding in memory.
+            pending = {}
+
+            def wait_for_files(all_files=False):
+                """Waits for the threads to finish writing some of the pending files, or all of them if all_files
+                is True, and raises any error from writing them. """
+
+                if all_files:
+                    done = set(pending)
+                    concurrent.futures.wait(done)
+                else:
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    del pending[future]
+                    future.result()
+
+            for member in tar:
+
+                # Does not extract anything that would be saved outside the destination folder.
+                if is_unsafe(member.name):
+                    raise tarfile.TarError(f"Unsafe path in tar file: {member.name}")
+                path = os.path.join(destination, member.name)
+
+                if member.isdir():
+                    make_directory(path)
+                elif member.isfile():
+                    make_directory(os.path.dirname(path))
+                    remove_link(path)
+                    if member.size > max_buffered_size:
+                        with open(path, "wb") as new_file:
+                            shutil.copyfileobj(tar.extractfile(member), new_file, copy_buffer_size)
+                    else:
+                        pending[executor.submit(write_file, path, tar.extractfile(member).read())] = member.size
+
+                # Makes links the same way tar does, as long as they point to something within the destination folder
+                # once any links already made are followed. A symbolic link's target is relative to the folder the
+                # link is in. A hard link's target is a path from the tar. Waits for all pending files first, so a
+                # hard link's target has been written and no file is still waiting to be written to a path that
+                # could now go through the new link. Anything already at the path is replaced.
+                # Since a new link can change where paths go, every directory is checked again after a link is made.
+                elif member.issym() or member.islnk():
+                    if member.issym():
+                        target = os.path.join(os.path.dirname(member.name), member.linkname)
+                    else:
+                        target = member.linkname
+                    if os.path.isabs(member.linkname) or is_unsafe(target):
+                        raise tarfile.TarError(f"Unsafe link in tar file: {member.name} to {member.linkname}")
+                    make_directory(os.path.dirname(path))
+                    check_path(os.path.join(destination, target))
+                    wait_for_files(all_files=True)
+                    if os.path.lexists(path):
+                        os.remove(path)
+                    if member.issym():
+                        os.symlink(member.linkname, path)
+                    else:
+                        os.link(os.path.join(destination, target), path)
+                    made_directories.clear()
+
+                # Any other type of member, such as a device file, is not expected in an AIP.
+                else:
+                    raise tarfile.TarError(f"Unsupported type of file in tar file: {member.name}")
+
+                # Waits for some files to be written once there are more waiting than threads or the files waiting
+                # are using too much memory, so the whole AIP is not held in memory.
+                while pending and (len(pending) >= workers * 2 or sum(pending.values()) > max_pending_size):
+                    wait_for_files()
+
+            wait_for_files(all_files=True)
+
+        # Reads the rest of the unzipping program's output, which is padding after the end of the tar,
+        # so it is not stopped for writing to a closed pipe.
+        if unzip:
+            while unzip.stdout.read(1024 * 1024):
+                pass
+    finally:
+        if unzip:
+            unzip.stdout.close()
+            unzip.wait()
+
+    # Raises an error if the unzipping program did not finish successfully.
+    if unzip and unzip.returncode != 0:
+        raise subprocess.CalledProcessError(unzip.returncode, unzip.args)
+
+
+def unpack(aip_zip):
+    """Unzips (if applicable) and untars the AIP, using different commands for Windows or Mac/Linux. The result is
+    the AIP's bag directory, named aip_path-id_bag, which is saved to a folder named aptrust-aips within the AIPs
+    directory. The original tar and zip files remain in the AIPs directory in case the script needs to be run again.
+    Raises subprocess.CalledProcessError, tarfile.TarError, or OSError if the AIP could not be unpacked. """
+
+    # If a number of threads is set with APTRUST_UNTAR_CONCURRENCY, unpacks with Python instead of 7-Zip or tar.
+    # This works the same way on every operating system, since Python can read zipped tars itself.
+    if UNTAR_CONCURRENCY > 0:
+        parallel_untar(aip_zip, "aptrust-aips", UNTAR_CONCURRENCY)
+        return
+
+    # For Windows, use 7-Zip to extract the files, saving the bag to a folder within the AIPs directory named
+    # aptrust-aips. The paths are relative to the AIPs directory, which is the current directory.
+    if IS_WINDOWS:
+
+        # If the AIP is both tarred and zipped, one 7-Zip command unzips the tar to its output (-so), which is piped
+        # to a second 7-Zip command that untars it (-si), so the intermediate tar file is never saved to the disk.
+        # Unzipping uses this AIP's share of the CPUs (-mmt). The progress indicator is turned off (-bd) and any
+        # question is answered yes (-y), since nobody can respond while the script runs.
+        # Raises an error if either command does not finish successfully.
         if aip_zip.endswith(".bz2"):
-            os.remove(os.path.join(aips_directory, aip_zip.replace(".bz2", "")))
+            unzip = subprocess.Popen([SEVEN_ZIP, "x", f"-mmt={CPUS_PER_AIP}", "-bd", "-so", aip_zip],
+                                     stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+            untar = subprocess.run([SEVEN_ZIP, "x", "-bd", "-y", "-si", "-ttar", "-oaptrust-aips"],
+                                   stdin=unzip.stdout, stdout=subprocess.DEVNULL)
+            unzip.stdout.close()
+            if unzip.wait() != 0:
+                raise subprocess.CalledProcessError(unzip.returncode, unzip.args)
+            untar.check_returncode()
+
+        # If the AIP is just tarred, extracts the contents of the tar file, which is the AIP's bag directory.
+        else:
+            subprocess.run([SEVEN_ZIP, "x", "-bd", "-y", aip_zip, "-oaptrust-aips"],
+                           stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, check=True)
 
     # For Mac and Linux, use tar to extract the AIP's bag directory.
     # This command works if the AIP is tarred and zipped or if it is just tarred.
+    # If lbzip2 or pbzip2 is installed, tar uses it to unzip, so the unzipping is done by all the CPUs.
     # Makes the aptrust-aips directory to save the bag to, if it doesn't already exist, before extracting.
     else:
-        if not os.path.exists("aptrust-aips"):
-            os.makedirs("aptrust-aips")
-        subprocess.run(f'tar -xf "{aip_zip}" -C aptrust-aips', shell=True)
+        os.makedirs("aptrust-aips", exist_ok=True)
+        if aip_zip.endswith(".bz2") and PARALLEL_BZIP2:
+            tar_command = [TAR, f"--use-compress-program={PARALLEL_BZIP2}", "-xf", aip_zip, "-C", "aptrust-aips"]
+        else:
+            tar_command = [TAR, "-xf", aip_zip, "-C", "aptrust-aips"]
+        subprocess.run(tar_command, stdin=subprocess.DEVNULL, check=True)
 
 
 def size_check(aip_path):
@@ -71,358 +297,553 @@ def size_check(aip_path):
     # Variable for calculating the total bag size.
     bag_size = 0
 
-    # Adds the size of all the bag metadata files.
-    for file in os.listdir(aip_path):
-        if file.endswith('.txt'):
-            bag_size += os.path.getsize(f"{aip_path}/{file}")
-
     # Adds the bag payload size (the size of everything in the bag data folder) to the bag size.
-    bag_info = open(f"{aip_path}/bag-info.txt", "r")
-    for line in bag_info:
-        if line.startswith("Payload-Oxum"):
-            payload = line.split()[1]
-            bag_size += float(payload)
+    # Memory maps bag-info.txt and searches it for the Payload-Oxum line, instead of reading it line by line.
+    # An empty file cannot be memory mapped, and has no Payload-Oxum to add, so it is skipped.
+    with open(f"{aip_path}/bag-info.txt", "rb") as bag_info:
+        if os.fstat(bag_info.fileno()).st_size > 0:
+            with mmap.mmap(bag_info.fileno(), 0, access=mmap.ACCESS_READ) as bag_info_map:
+                payload = PAYLOAD_OXUM.search(bag_info_map)
+                if payload:
+                    bag_size += float(payload.group(1))
 
-    # Evaluates if the size is below the 5 TB limit and return the result (True or False).
-    return bag_size < 5000000000000
-
-
-def length_check(aip_path, aip_name):
-    """Tests if all file and directory name lengths are at least one character but no more than 255 characters.
-    Returns True if all names are within the limits or False if any names are outside the limits. Also creates a
-    document with any names that are outside the limits for staff review. """
-
-    # Makes a list to store lists with the path, name, and number of characters for each name outside the limits.
-    # Each name's list will become a row in the character_limit_errors.csv.
-    wrong_length = []
-
-    # Checks the length of the AIP (top level folder).
-    # If it is too long or 0, adds it to the wrong_length list.
-    # Checking the AIP instead of root because everything in root except the AIP is also included in directories.
-    if len(aip_name) > 255 or len(aip_name) == 0:
-        wrong_length.append([aip_path, aip_name, len(aip_name)])
-
-    # Checks the length of every directory and file.
-    # If any name is too long or 0, adds it to the wrong_length list.
-    for root, directories, files in os.walk(aip_path):
-        for directory in directories:
-            if len(directory) > 255 or len(directory) == 0:
-                path = os.path.join(root, directory)
-                wrong_length.append([path, directory, len(directory)])
-        for file in files:
-            if len(file) > 255 or len(file) == 0:
-                path = os.path.join(root, file)
-                wrong_length.append([path, file, len(file)])
-
-    # If any names were too long or 0, saves them to a CSV in the AIPs directory for staff review.
-    # The CSV is moved to the error folder with the bag once the error folder is made.
-    # Also returns False if any names were the incorrect length or True if all lengths were correct.
-    if len(wrong_length) > 0:
-        with open(f"{aip_name}_character_limit_log.csv", "a", newline='') as result:
-            writer = csv.writer(result)
-            writer.writerow(["Path", "Name", "Length of Name"])
-            for name_list in wrong_length:
-                writer.writerow(name_list)
-        return False
-    else:
-        return True
-
-
-def character_check(aip_path, aip_name):
-    """Tests if there are any impermissible characters in file and directory names. Names must not start with a dash
-    or contain a newline, carriage return, tab, vertical tab, or ascii bell. Returns True if all name characters are
-    permitted or False if not. Also creates a document with any names that include impermissible characters for staff
-    review.
-
-    Future development idea: if this happens enough, could add which character(s) were found. Right now, just returns
-    False as soon as the first impermissible character is found."""
-
-    def name_check(name):
-        """Tests if a single file or directory name includes any impermissible characters. Returns True or False. """
-
-        # Checks if the name starts with a dash (not permitted).
-        if name.startswith("-"):
-            return False
-
-        # Checks if the name includes any characters that are not permitted.
-        not_permitted = ["\n", "\r", "\t", "\v", "\a"]
-        for character in not_permitted:
-            if character in name:
-                return False
-
-        # If neither of the previous code blocks returned False, then all characters in the name are permitted.
-        return True
-
-    # Makes a list for file or directory names, including their full path, that contain impermissible characters.
-    name_errors = []
-
-    # Checks the AIP name and adds it to the name_errors list if there are impermissible characters.
-    # Checking the AIP instead of root because everything in root except the AIP is checked as part of directories.
-    if name_check(aip_name) is False:
-        name_errors.append(os.path.join("aptrust-aips", aip_name))
-
-    # Checks every directory and file name in the AIP. If there are impermissible characters, calculates the full
-    # path for that directory or file and adds it to the name_errors list .
-    for root, directories, files in os.walk(aip_path):
-        for file in files:
-            if name_check(file) is False:
-                name_errors.append(os.path.join(root, file))
-        for directory in directories:
-            if name_check(directory) is False:
-                name_errors.append(os.path.join(root, directory))
-
-    # If any names have impermissible characters, saves them to a CSV in the AIPs directory for staff review.
-    # Saves as a CSV even though there is only one column to make it faster to open in a spreadsheet for analysis.
-    # This is saved in the AIPs directory but is moved to the error folder with the bag once the error folder is made.
-    # Also returns False if impermissible characters were found or True if all characters are permitted.
-    if len(name_errors) > 0:
-        with open(f"{aip_name}_impermissible_characters_log.csv", "a", newline='') as result:
-            writer = csv.writer(result)
-            writer.writerow(["Name with Impermissible Characters"])
-            for name_path in name_errors:
-                writer.writerow([name_path])
+    # Adds the size of all the bag metadata files.
+    # The payload is nearly all of the bag size, so it is added first and the check stops as soon as the running
+    # total is over the limit, without getting the size of the rest of the metadata files.
+    # Uses scandir so the size comes from the directory entry, which on Windows does not require another system call.
+    if bag_size >= BAG_SIZE_LIMIT:
         return False
-    else:
-        return True
+    with os.scandir(aip_path) as entries:
+        for entry in entries:
+            if entry.name.endswith('.txt'):
+                bag_size += entry.stat(follow_symlinks=False).st_size
+                if bag_size >= BAG_SIZE_LIMIT:
+                    return False
 
-
-def add_bag_metadata(aip_path, aip_name):
+    # Evaluates if the size is below the 5 TB limit and return the result (True or False).
+    return bag_size < BAG_SIZE_LIMIT
+
+
+def scandir_walk(top):
+    """Yields every file and directory within the top directory, including in subdirectories, as os.DirEntry objects.
+    Uses scandir instead of os.walk so that telling files from directories does not need another system call, and a
+    list of directories still to read instead of recursion, so only one directory is open at a time. """
+
+    directories = [top]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                yield entry
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+
+
+def name_check(name):
+    """Tests if a single file or directory name includes any impermissible characters. Names must not start with a
+    dash or contain a newline, carriage return, tab, vertical tab, or ascii bell. Returns a description of the first
+    impermissible character found or None if all characters in the name are permitted. """
+
+    # Checks if the name starts with a dash (not permitted).
+    if name.startswith("-"):
+        return "dash at start of name"
+
+    # Checks if the name includes any characters that are not permitted.
+    # All of them are control characters, so a name where every character is printable (checked in one pass in C,
+    # which is true for nearly every name) is permitted without searching it for each character separately.
+    if name.isprintable():
+        return None
+    for character in NOT_PERMITTED:
+        if character in name:
+            return NOT_PERMITTED[character]
+
+    # If neither of the previous code blocks returned, then all characters in the name are permitted.
+    return None
+
+
+def precheck(aip_path, aip_name, fail_fast=True):
+    """Tests if the AIP meets the APTrust requirements for bag size (under 5 TB), file and directory name length (at
+    least one character but no more than 255 characters), and characters permitted in file and directory names.
+    The names are checked in a single walk of the AIP. Returns a tuple with the result of each test (True or False)
+    and the lists of names outside the character limit and with impermissible characters, for staff review:
+    (size_ok, length_ok, characters_ok, length_errors, character_errors).
+
+    Every name is checked for length, so the list of names outside the character limit is always complete.
+    By default (fail_fast is True), the characters are no longer checked after the first impermissible name, since
+    one is enough to stop processing the AIP. Use fail_fast=False to check the characters of every name for a complete
+    list. The AIP is not walked at all if it is too big, since that already stops processing the AIP."""
+
+    # Makes a list to store lists with the path, name, and number of characters for each name outside the limits,
+    # and a list to store lists with the path and impermissible character for each name with impermissible characters.
+    length_errors = []
+    character_errors = []
+
+    def check_name(path, name):
+        """Tests the length and characters of a single file or directory name and adds it to the error lists if it
+        does not meet the requirements. If fail_fast is True, the characters are only tested until the first
+        impermissible character is found. """
+
+        if len(name) > 255 or len(name) == 0:
+            length_errors.append([path, name, len(name)])
+
+        if not (fail_fast and character_errors):
+            character = name_check(name)
+            if character:
+                character_errors.append([path, character])
+
+    # Tests the bag size first, which does not require walking the AIP.
+    size_ok = size_check(aip_path)
+
+    # Checks the AIP name (top level folder) and then every directory and file name within the AIP.
+    if size_ok:
+        check_name(aip_path, aip_name)
+        for entry in scandir_walk(aip_path):
+            check_name(entry.path, entry.name)
+
+    return size_ok, len(length_errors) == 0, len(character_errors) == 0, length_errors, character_errors
+
+
+def save_name_errors(csv_path, header, name_errors):
+    """Saves the list of names that do not meet APTrust requirements to a CSV for staff review. Most rows are saved
+    by joining the values with commas, which is faster than the csv module for AIPs with many errors. Rows with a
+    value that needs quotes (it contains a comma, quote, or line break) are saved with the csv module instead. """
+
+    with open(csv_path, "a", newline='') as result:
+        writer = csv.writer(result)
+        writer.writerow(header)
+        for name_error in name_errors:
+            values = [str(value) for value in name_error]
+            if any(character in value for value in values for character in ',"\r\n') or "" in values:
+                writer.writerow(values)
+            else:
+                result.write(",".join(values) + "\r\n")
+
+
+def add_bag_metadata(bag, aip_name):
     """Adds additional fields to bagit-info.txt and adds a new file aptrust-info.txt to the bag metadata. The values
     for the metadata fields are either consistent for all UGA AIPs or are extracted from the preservation.xml file
-    that is in the AIP's metadata folder. """
+    that is in the AIP's metadata folder. Uses the bagit object for the AIP that was already made by the main loop,
+    so the bag files do not need to be read again. """
+
+    # Path to the AIP's bag.
+    aip_path = bag.path
 
-    # Namespaces that find() will use when navigating the preservation.xml.
-    ns = {"dc": "http://purl.org/dc/terms/", "premis": "http://www.loc.gov/premis/v3"}
+    # AIP id, which is the bag name without the _bag suffix. Only the end of the name is removed, in case _bag is also
+    # part of the id, and it is calculated once for the metadata file names and bag-info.txt.
+    aip_id = aip_name[:-4] if aip_name.endswith("_bag") else aip_name
 
-    # Reads the data from the AIP metadata file, which may be named aip-id_preservation.xml or aip-id_master.xml.
+    # Opens the AIP metadata file, which may be named aip-id_preservation.xml or aip-id_master.xml.
     # If the preservation.xml is not found, raises an error so the script can stop processing this AIP.
     try:
-        tree = et.parse(f"{aip_path}/data/metadata/{aip_name.replace('_bag', '')}_preservation.xml")
-        root = tree.getroot()
+        xml_file = open(f"{aip_path}/data/metadata/{aip_id}_preservation.xml", "rb")
     except FileNotFoundError:
         try:
-            tree = et.parse(f"{aip_path}/data/metadata/{aip_name.replace('_bag', '')}_master.xml")
-            root = tree.getroot()
+            xml_file = open(f"{aip_path}/data/metadata/{aip_id}_master.xml", "rb")
         except FileNotFoundError:
             raise FileNotFoundError
 
-    # For the next three try/except blocks, et.ParseError is from not finding the expected field in the preservation.xml
-    # and AttributeError is from trying to get text from the variable for the missing field, which has a value of None.
+    # Reads the preservation.xml one element at a time, keeping track of the path to the current element, and saves
+    # the text of the first title and objectIdentifierType and the first relatedObjectIdentifierValue in each
+    # relationship. Stops reading after the aip section if the title has been found, instead of reading the rest of
+    # the preservation.xml (the list of files, which can be large) into memory. Elements are cleared once read.
+    # The file is opened by the script instead of by iterparse, so it is closed as soon as reading stops, even when
+    # that is before the end of the file. Otherwise, the open file could stop the bag folder being moved on Windows.
+    with xml_file:
+        xml_events = et.iterparse(xml_file, events=("start", "end"))
+        path = []
+        title = None
+        uri = None
+        collections = []
+        for event, element in xml_events:
+            if event == "start":
+                path.append(element.tag)
+                if tuple(path[1:]) == RELATIONSHIP_PATH:
+                    collections.append(None)
+                continue
+
+            element_path = tuple(path[1:])
+            if element_path == TITLE_PATH and title is None:
+                title = element.text
+            elif element_path == URI_PATH and uri is None:
+                uri = element.text
+            elif element_path == COLLECTION_PATH and collections[-1] is None:
+                collections[-1] = element.text
+            path.pop()
+            element.clear()
+
+            if element_path == ("aip",) and title is not None:
+                break
 
     # Gets the group id from the value of the first objectIdentifierType (the ARCHive URI).
-    # Starts at the 28th character to skip the ARCHive part of the URI and just get the group code.
+    # The group code is the last part of the URI, after the ARCHive address.
     # If this field (which is required) is missing, raises an error so the script can stop processing this AIP.
-    try:
-        object_id_field = root.find("aip/premis:object/premis:objectIdentifier/premis:objectIdentifierType", ns)
-        uri = object_id_field.text
-        group = uri[28:]
-    except (et.ParseError, AttributeError):
+    if uri is None:
         raise ValueError("premis:objectIdentifierType")
+    group = uri.rsplit("/", 1)[-1]
 
     # Gets the title from the value of the title element.
     # If this field (which is required) is missing, raises an error so the script can stop processing this AIP.
-    try:
-        title = root.find("dc:title", ns).text
-    except (et.ParseError, AttributeError):
+    if title is None:
         raise ValueError("dc:title")
 
-    # Gets the collection id from the value of the first relatedObjectIdentifierValue in the aip_path section.
+    # Gets the collection id from the value of the first relatedObjectIdentifierValue in the aip section.
     # If there is no collection id (e.g. for some web archives), supplies default text.
-    id = "aip/premis:object/premis:relationship/premis:relatedObjectIdentifier/premis:relatedObjectIdentifierValue"
-    try:
-        collection = root.find(id, ns).text
-    except (et.ParseError, AttributeError):
+    found_collections = [value for value in collections if value is not None]
+    if found_collections:
+        collection = found_collections[0]
+    else:
         collection = "This AIP is not part of a collection."
 
     # For DLG newspapers, the first relationship is dlg and the second is the collection.
     # Updates the value of collection to be the text of the second relationship instead.
+    # If there is no second relationship, raises an error so the script can stop processing this AIP.
     if collection == "dlg":
-        id = "aip/premis:object/premis:relationship[2]/premis:relatedObjectIdentifier/premis:relatedObjectIdentifierValue"
-        collection = root.find(id, ns).text
+        if len(collections) < 2 or collections[1] is None:
+            raise ValueError("second premis:relationship")
+        collection = collections[1]
 
     # Adds the required fields to bagit-info.txt.
-    bag = bagit.Bag(aip_path)
     bag.info['Source-Organization'] = "University of Georgia"
     bag.info['Internal-Sender-Description'] = f"UGA unit: {group}"
-    bag.info['Internal-Sender-Identifier'] = aip_name.replace("_bag", "")
+    bag.info['Internal-Sender-Identifier'] = aip_id
     bag.info['Bag-Group-Identifier'] = collection
 
-    # Makes aptrust-info.txt.
+    # Makes aptrust-info.txt, writing all the fields at once.
     with open(f"{aip_path}/aptrust-info.txt", "w") as new_file:
-        new_file.write(f"Title: {title}\n")
-        new_file.write("Access: Institution\n")
-        new_file.write("Storage-Option: Glacier-Deep-OR\n")
+        new_file.write(f"Title: {title}\nAccess: Institution\nStorage-Option: Glacier-Deep-OR\n")
 
     # Saves the bag, which updates the tag manifests with the new file aptrust-info.txt and the new checksums for the
-    # edited file bagit-info.txt so the bag remains valid.
-    bag.save(manifests=True)
+    # edited file bagit-info.txt so the bag remains valid. Only the tag files are hashed: the payload manifests are
+    # not remade (manifests=False) because no payload files were changed, so their checksums are still correct.
+    bag.save(manifests=False)
 
 
 def tar_bag(aip_path):
-    """Tars the bag, using the appropriate command for Windows (7zip) or Mac/Linux (tar) operating systems."""
+    """Tars the bag, using Python's tarfile for Windows or tar for Mac/Linux, so the tar only has the bag folder at
+    the top level. Raises subprocess.CalledProcessError, tarfile.TarError, or OSError if the bag could not be tarred."""
+
+    # Tars the AIP using the operating system-specific method.
+    # For Windows, Python writes the tar itself, which does not need to start a 7-Zip process for every AIP.
+    # The files are copied into the tar in 4 MB pieces instead of the default of 16 KB, for fewer reads and writes.
+    # For Mac/Linux, runs tar from the folder with the bag (-C) so the tar does not include the aptrust-aips folder.
+    aip_folder, aip_name = os.path.split(aip_path)
+    if IS_WINDOWS:
+        with tarfile.open(f"{aip_path}.tar", "w", copybufsize=4 * 1024 * 1024) as tar:
+            tar.add(aip_path, arcname=aip_name)
+    else:
+        subprocess.run([TAR, "-cf", f"{aip_path}.tar", "-C", aip_folder, aip_name], stdin=subprocess.DEVNULL,
+                       check=True)
+
+
+def validate_tag_manifests(bag):
+    """Checks the checksums in each tag manifest against the tag files (bagit.txt, bag-info.txt, aptrust-info.txt,
+    and the payload manifests), which are the only files that change when the bag is transformed. The tag files are
+    small, so this is much faster than validating the payload checksums again.
+    Raises bagit.BagValidationError if a tag file is missing or its checksum does not match. """
+
+    for tagmanifest_path in bag.tagmanifest_files():
+
+        # Gets the algorithm from the tag manifest name, which is tagmanifest-algorithm.txt.
+        tagmanifest_name = os.path.basename(tagmanifest_path)
+        algorithm = tagmanifest_name[len("tagmanifest-"):-len(".txt")]
+
+        # Each line of the tag manifest is the checksum and the path of a tag file, separated by whitespace.
+        with open(tagmanifest_path, encoding="utf-8") as tagmanifest:
+            for line in tagmanifest:
+                if not line.strip():
+                    continue
+                expected, tag_file = line.strip().split(maxsplit=1)
+                try:
+                    with open(os.path.join(bag.path, tag_file), "rb") as tag:
+                        actual = hashlib.new(algorithm, tag.read()).hexdigest()
+                except FileNotFoundError:
+                    raise bagit.BagValidationError(f"{tag_file} is in {tagmanifest_name} but is missing")
+                if actual != expected.lower():
+                    raise bagit.BagValidationError(f"{tag_file} does not match the checksum in {tagmanifest_name}")
+
+
+def hash_processes(bag):
+    """Returns the number of threads (bagit calls them processes) for bagit to use when validating checksums. Bags
+    with a payload of at least 16 MB use one thread per CPU, shared between the AIPs that are transformed at the same
+    time, so files are hashed in parallel. Smaller bags use one thread, since they are hashed about as quickly as the
+    threads can be started. """
+
+    # The first part of Payload-Oxum is the size of the payload in bytes.
+    payload_bytes = int(bag.info.get("Payload-Oxum", "0.0").split(".")[0])
+    if payload_bytes < 16 * 1024 * 1024:
+        return 1
+    return CPUS_PER_AIP
+
+
+class HashThreadPool(multiprocessing.pool.ThreadPool):
+    """Pool of threads that bagit uses instead of a pool of processes to validate checksums in parallel. hashlib and
+    reading files both release the GIL, so threads hash files at the same time without the cost of starting a process
+    for each one, which on Windows also imports this script and bagit again. bagit's initializer for its processes is
+    not used, since it sets a signal handler, which can only be done in the main thread. """
+
+    def __init__(self, processes=None, initializer=None):
+        super().__init__(processes)
+
+
+@contextlib.contextmanager
+def hash_threads():
+    """Makes bagit start a HashThreadPool where it would start a multiprocessing Pool, which is the only part of
+    multiprocessing that bagit uses, for the bagit calls inside the with statement. bagit's multiprocessing is put back
+    afterwards, even if there is an error, so bagit is only changed while this script is validating a bag. """
+
+    original_multiprocessing = bagit.multiprocessing
+    bagit.multiprocessing = types.SimpleNamespace(Pool=HashThreadPool)
+    try:
+        yield
+    finally:
+        bagit.multiprocessing = original_multiprocessing
 
-    # Gets the operating system, which determines the command for unzipping and untarring.
-    operating_system = platform.system()
 
-    # Gets the absolute path to the bag.
-    bag_path = os.path.join(aips_directory, aip_path)
+def sha256_speed_check():
+    """Tests how fast this computer calculates SHA-256 checksums, by hashing 64 MB, and prints a warning if it is
+    slower than expected when Python's OpenSSL uses the processor's SHA extensions (SHA-NI). Most of the time for
+    large AIPs is spent calculating checksums, which can be several times slower without them. """
 
-    # Tars the AIP using the operating system-specific command, 7-zip for Windows and tar for Mac/Linux.
-    if operating_system == "Windows":
-        subprocess.run(f'7z -ttar a "{aip_path}.tar" "{bag_path}"', stdout=subprocess.DEVNULL, shell=True)
-    else:
-        subprocess.run(f'tar -cf "{aip_path}.tar" "{aip_path}"', shell=True)
-
-
-def log(log_path, log_row):
-    """Adds a line to the script progress log."""
-
-    with open(log_path, "a", newline="") as log_file:
-        log_writer = csv.writer(log_file)
-        log_writer.writerow(log_row)
-
-
-# Prints a message about the version of the script, in case the user meant to select the other branch.
-print('\nRunning the main branch of the APTrust transformation script, used for AIPS under 20 GB.')
-print('AIPs will be unzipped and tarred as part of the script, which becomes too slow for anything over 20 GB.')
-print('For larger AIPs, use the "no-zip" branch of the script instead.\n')
-
-# Gets the directory from the script argument. If it is missing, prints an error and quits the script.
-try:
-    aips_directory = sys.argv[1]
-except IndexError:
-    print("Missing the AIPs directory, which is a required script argument.")
-    print("Script usage: python /path/aptrust_aip.py /path/aips_directory")
-    exit()
-
-# Makes the AIPs directory the current directory. If it is not a valid directory, prints an error and quits the script.
-try:
-    os.chdir(aips_directory)
-except (FileNotFoundError, NotADirectoryError):
-    print("The provided AIPs directory is not a valid directory:", aips_directory)
-    print("Script usage: python /path/aptrust_aip.py /path/aips_directory")
-    exit()
-
-# Tracks the number of AIPs fully transformed or with errors for making a summary of the script's success.
-# Records the script start time to later calculate how long the script took to run.
-aips_transformed = 0
-aips_errors = 0
-script_start = datetime.datetime.today()
-
-# Saves the log path to a variable, for use throughout the script.
-# If the log doesn't exist from earlier batches in the same day, adds a header row.
-log_path = f"AIP_Transformation_Log_{script_start.date()}.csv"
-if not os.path.exists(os.path.join(aips_directory, log_path)):
-    log(log_path, ["AIP", "Errors", "Transformation Result"])
-
-# Gets each AIP in the AIPs directory and transforms it into an APTrust-compatible AIP.
-# Any AIP with an anticipated error is moved to a folder with the error name so processing can stop on that AIP.
-for item in os.listdir():
-
-    # Skip anything in the AIPs directory that isn't an AIP, such as the log, based on the file extension.
-    if not (item.endswith(".tar.bz2") or item.endswith(".tar")):
-        continue
+    test_data = bytes(64 * 1024 * 1024)
+    start = time.perf_counter()
+    hashlib.sha256(test_data)
+    gb_per_second = len(test_data) / (time.perf_counter() - start) / 1000000000
+
+    if gb_per_second < 0.75:
+        print(f"Warning: SHA-256 checksums are calculated at {gb_per_second:.2f} GB per second, which suggests the SHA "
+              f"extensions of the processor are not being used. Bag validation will be slower.")
+        print("Use Python with OpenSSL 1.1.1 or newer on a processor with SHA extensions for the best speed.\n")
+
+
+def process_aip(item):
+    """Transforms one AIP file from the AIPs directory into an APTrust-compatible AIP. Any AIP with an anticipated
+    error is moved to a folder with the error name so processing can stop on that AIP. Returns the row for the
+    script log and, if there are names that do not meet APTrust requirements, the arguments for save_name_errors().
+    The log and error CSVs are saved by the main script, so only one process ever writes to them. """
 
     # Prints script progress to show it is still working.
     print("Starting transformation of:", item)
 
-    # Calculates the bag name (aip-id_bag) from the file name for referring to the AIP after it is untarred/unzipped.
+    # Calculates the bag name (aip-id_bag) from the file name for referring to the AIP after it is unpacked.
     # Stops processing this AIP if the bag name does not match the expected pattern.
     try:
-        regex = re.match("^(.*_bag).", item)
+        regex = BAG_NAME.match(item)
         aip_bag_name = regex.group(1)
     except AttributeError:
-        log(log_path, [item, "AIP file name does not include aip-id_bag", "Incomplete"])
         move_error("bag_name", item, item)
-        aips_errors += 1
-        continue
+        return [item, "AIP file name does not include aip-id_bag", "Incomplete"], None
 
     # Unpacks the AIP's bag directory from the zip and/or tar file.
     # The original zip and/or tar file is retained in case the script needs to be run again.
-    unpack(item)
+    # Stops processing this AIP if 7-Zip, tar, or Python's tarfile reports an error, or a file could not be saved.
+    try:
+        unpack(item)
+    except (subprocess.CalledProcessError, tarfile.TarError, OSError) as error:
+        move_error("unpack_error", item, item)
+        return [item, f"Could not unpack the AIP: {error}", "Incomplete"], None
 
     # Variable that combines the aip_bag_name with the folder within the AIPs directory that it was saved to.
     aip_bag_path = os.path.join("aptrust-aips", aip_bag_name)
 
     # Validates the unpacked bag in case there was a problem during storage or unpacking.
+    # For larger bags, the checksums are calculated by several threads in parallel.
     # Stops processing this AIP if the bag is invalid.
     try:
         aip_bagit_object = bagit.Bag(aip_bag_path)
-        aip_bagit_object.validate()
+        with hash_threads():
+            aip_bagit_object.validate(processes=hash_processes(aip_bagit_object))
     except bagit.BagValidationError as errors:
-        log(log_path, [item, f"The unpacked bag is not valid: {errors}", "Incomplete"])
         move_error("unpacked_bag_not_valid", aip_bag_path, aip_bag_name)
-        aips_errors += 1
-        continue
+        return [item, f"The unpacked bag is not valid: {errors}", "Incomplete"], None
+
+    # Validates the AIP against the APTrust requirements for size and for the length and characters of directory and
+    # file names. The names are all checked in a single walk of the AIP, which lists every impermissible name only if
+    # APTRUST_CHECK_ALL_NAMES is set.
+    size_ok, length_ok, characters_ok, length_errors, character_errors = precheck(aip_bag_path, aip_bag_name,
+                                                                                  fail_fast=not CHECK_ALL_NAMES)
 
-    # Validates the AIP against the APTrust size requirement.
     # Stops processing this AIP if it is too big (above 5 TB).
-    size_ok = size_check(aip_bag_path)
     if not size_ok:
-        log(log_path, [item, "Above the 5TB limit", "Incomplete"])
         move_error("bag_size_limit", aip_bag_path, aip_bag_name)
-        aips_errors += 1
-        continue
+        return [item, "Above the 5TB limit", "Incomplete"], None
 
-    # Validates the AIP against the APTrust character length requirements for directories and files.
-    # Produces a list for staff review and stops processing this AIP if any are 0 characters or more than 255.
-    # The list is moved to the error folder, along with the bag, once the error folder is made.
-    length_ok = length_check(aip_bag_path, aip_bag_name)
+    # Stops processing this AIP if any names are 0 characters or more than 255.
+    # Also returns a list of the names for staff review, which is saved to the error folder by the main script.
     if not length_ok:
-        log(log_path, [item, "Name(s) outside the character limit", "Incomplete"])
         move_error("character_limit", aip_bag_path, aip_bag_name)
-        log_name = f"{aip_bag_name}_character_limit_log.csv"
-        os.replace(log_name, os.path.join("errors", "character_limit", log_name))
-        aips_errors += 1
-        continue
-
-    # Validates the AIP against the APTrust character requirements for directories and files.
-    # Produces a list for staff review and stops processing this AIP if any impermissible characters are found.
-    # The list is moved to the error folder, along with the bag, once the error folder is made.
-    characters_ok = character_check(aip_bag_path, aip_bag_name)
+        name_errors = (os.path.join("errors", "character_limit", f"{aip_bag_name}_character_limit_log.csv"),
+                       ["Path", "Name", "Length of Name"], length_errors)
+        return [item, "Name(s) outside the character limit", "Incomplete"], name_errors
+
+    # Stops processing this AIP if any impermissible characters are found.
+    # Also returns a list of the names for staff review, which is saved to the error folder by the main script.
     if not characters_ok:
-        log(log_path, [item, "Impermissible characters", "Incomplete"])
         move_error("impermissible_characters", aip_bag_path, aip_bag_name)
-        log_name = f"{aip_bag_name}_impermissible_characters_log.csv"
-        os.replace(log_name, os.path.join("errors", "impermissible_characters", log_name))
-        aips_errors += 1
-        continue
+        name_errors = (os.path.join("errors", "impermissible_characters",
+                                    f"{aip_bag_name}_impermissible_characters_log.csv"),
+                       ["Name with Impermissible Characters", "Impermissible Character"], character_errors)
+        return [item, "Impermissible characters", "Incomplete"], name_errors
 
     # Updates the bag metadata files to meet APTrust requirements.
     try:
-        add_bag_metadata(aip_bag_path, aip_bag_name)
+        add_bag_metadata(aip_bagit_object, aip_bag_name)
     except FileNotFoundError:
-        log(log_path, [item, "The preservation.xml is missing.", "Incomplete"])
         move_error("no_preservationxml", aip_bag_path, aip_bag_name)
-        aips_errors += 1
-        continue
+        return [item, "The preservation.xml is missing.", "Incomplete"], None
     except ValueError as error:
-        log(log_path, [item, f"The preservation.xml is missing the {error.args[0]}", "Incomplete"])
         move_error("incomplete_preservationxml", aip_bag_path, aip_bag_name)
-        aips_errors += 1
-        continue
+        return [item, f"The preservation.xml is missing the {error.args[0]}", "Incomplete"], None
 
     # Validates the bag in case there was a problem transforming it to an APTrust AIP.
+    # Reuses the bagit object, which was updated when the bag was saved, instead of reading the bag files again.
+    # This checks the bag structure, the Payload-Oxum if the bag has one, and that the files in the payload match the
+    # payload manifests (completeness_only), plus the checksums of the tag files. The payload checksums are not
+    # calculated again, since they were validated after unpacking and the payload has not changed since then.
     # Stops processing this AIP if the bag is invalid.
     try:
-        aip_bagit_object = bagit.Bag(aip_bag_path)
-        aip_bagit_object.validate()
+        aip_bagit_object.validate(completeness_only=True)
+        validate_tag_manifests(aip_bagit_object)
     except bagit.BagValidationError as errors:
-        log(log_path, [item, f"The transformed bag is not valid: {errors}", "Incomplete"])
         move_error("transformed_bag_not_valid", aip_bag_path, aip_bag_name)
-        aips_errors += 1
-        continue
+        return [item, f"The transformed bag is not valid: {errors}", "Incomplete"], None
 
     # Tars the bag. The tar file is saved to the same folder as the bag (aptrust-aips) within the AIPs directory.
-    tar_bag(aip_bag_path)
-
-    # Updates the log for the successfully transformed AIP.
-    log(log_path, [item, "n/a", "Complete"])
-    aips_transformed += 1
-
-# Prints summary information about the script's success.
-script_end = datetime.datetime.today()
-print(f"\nScript completed at {script_end}")
-print(f"Time to complete: {script_end - script_start}")
-print(f"{aips_transformed + aips_errors} AIPs were processed.")
-print(f"{aips_transformed} AIPs were successfully transformed and {aips_errors} AIPs had errors.")
+    # Stops processing this AIP if tar or Python's tarfile reports an error.
+    # Deletes any partial tar file so it is not uploaded.
+    try:
+        tar_bag(aip_bag_path)
+    except (subprocess.CalledProcessError, tarfile.TarError, OSError) as error:
+        move_error("tar_error", aip_bag_path, aip_bag_name)
+        if os.path.exists(f"{aip_bag_path}.tar"):
+            os.remove(f"{aip_bag_path}.tar")
+        return [item, f"Could not tar the bag: {error}", "Incomplete"], None
+
+    # Returns the log row for the successfully transformed AIP.
+    return [item, "n/a", "Complete"], None
+
+
+def log(log_file, log_row):
+    """Adds a line to the script progress log, using the log file that stays open while the script runs."""
+
+    log_writer = csv.writer(log_file)
+    log_writer.writerow(log_row)
+
+
+def completed_results(futures):
+    """Yields the result of each AIP transformed by a process in the order the AIPs finish. futures is a dictionary
+    of each future and the name of its AIP. If process_aip() raised an error that it did not handle, or the process
+    stopped, a log row for that AIP with the error is yielded instead, so the rest of the results are still saved."""
+
+    for future in concurrent.futures.as_completed(futures):
+        try:
+            yield future.result()
+        except Exception as error:
+            yield [futures[future], f"Unexpected error: {error}", "Incomplete"], None
+
+
+# Runs the script, unless this file is imported, such as by the processes started for APTRUST_AIP_PROCESSES.
+if __name__ == "__main__":
+
+    # Prints a message about the version of the script, in case the user meant to select the other branch.
+    print('\nRunning the main branch of the APTrust transformation script, used for AIPS under 20 GB.')
+    print('AIPs will be unzipped and tarred as part of the script, which becomes too slow for anything over 20 GB.')
+    print('For larger AIPs, use the "no-zip" branch of the script instead.\n')
+
+    # Gets the directory from the script argument. If it is missing, prints an error and quits the script.
+    try:
+        aips_directory = sys.argv[1]
+    except IndexError:
+        print("Missing the AIPs directory, which is a required script argument.")
+        print("Script usage: python /path/aptrust_aip.py /path/aips_directory")
+        sys.exit(2)
+
+    # Makes the AIPs directory the current directory.
+    # If it is not a valid directory, prints an error and quits the script.
+    try:
+        os.chdir(aips_directory)
+    except (FileNotFoundError, NotADirectoryError):
+        print("The provided AIPs directory is not a valid directory:", aips_directory)
+        print("Script usage: python /path/aptrust_aip.py /path/aips_directory")
+        sys.exit(2)
+
+    # Verifies the program for unzipping and tarring AIPs is installed.
+    # If it is not, prints an error and quits the script. A missing argument or program gives a different exit code,
+    # so anything that runs the script in a batch can tell an incorrect command (2) from a missing program (1).
+    if IS_WINDOWS and SEVEN_ZIP is None:
+        print("Could not find 7-Zip (7z), which is required to unzip and untar AIPs on Windows.")
+        sys.exit(1)
+    if not IS_WINDOWS and TAR is None:
+        print("Could not find tar, which is required to untar and tar AIPs on Mac and Linux.")
+        sys.exit(1)
+
+    # Prints a warning if checksums will be slow to calculate on this computer.
+    # This is done once the arguments and programs are known to be correct, so an error is reported without waiting.
+    sha256_speed_check()
+
+    # Tracks the number of AIPs fully transformed or with errors for making a summary of the script's success.
+    # Records the script start time to later calculate how long the script took to run.
+    aips_transformed = 0
+    aips_errors = 0
+    script_start = datetime.datetime.today()
+
+    # Opens the log once for use throughout the script, instead of opening and closing it for every row.
+    # It is line buffered so each row is saved as soon as it is written, even if the script stops unexpectedly.
+    # If the log doesn't exist from earlier batches in the same day (it is empty), adds a header row.
+    log_path = f"AIP_Transformation_Log_{script_start.date()}.csv"
+    log_file = open(log_path, "a", newline="", buffering=1)
+    if log_file.tell() == 0:
+        log(log_file, ["AIP", "Errors", "Transformation Result"])
+
+    # Gets each AIP in the AIPs directory, skipping anything that isn't an AIP, such as the log or a folder, based on
+    # the file extension and the file type from scandir, which does not need another system call for each item.
+    # The list is made before any AIPs are transformed, since error folders are added to the directory.
+    with os.scandir() as items:
+        aip_entries = [item for item in items
+                       if item.name.endswith((".tar.bz2", ".tar")) and item.is_file(follow_symlinks=False)]
+
+    # When more than one AIP is transformed at a time, the largest AIPs are started first. Otherwise, a large AIP
+    # that happens to be near the end of the list would still be running long after the other processes are done.
+    if AIP_PROCESSES > 1:
+        aip_entries.sort(key=lambda item: item.stat(follow_symlinks=False).st_size, reverse=True)
+    aips = [item.name for item in aip_entries]
+
+    # Transforms each AIP into an APTrust-compatible AIP. If APTRUST_AIP_PROCESSES is more than 1, that many AIPs are
+    # transformed at the same time in separate processes, with no more processes than AIPs. Each process starts in the
+    # AIPs directory, since all the paths are relative to it. The results are saved in the order the AIPs finish,
+    # so one large AIP does not hold up the log for the others, and an unexpected error in one AIP is saved to the log
+# without stopping the rest. Otherwise, they are transformed one at a time.
+    if AIP_PROCESSES > 1 and len(aips) > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=min(AIP_PROCESSES, len(aips)),
+                                                          initializer=os.chdir, initargs=(os.getcwd(),))
+        futures = {executor.submit(process_aip, item): item for item in aips}
+        results = completed_results(futures)
+    else:
+        executor = None
+        results = map(process_aip, aips)
+
+    # Saves the result of each AIP to the log and any list of names for staff review to a CSV in the error folder.
+    # This is only done here, so the log and error CSVs are not written by more than one process.
+    # If the CSV cannot be saved, prints the error and continues with the rest of the AIPs, since the AIP is already
+    # in the error folder and the log says why.
+    for log_row, name_errors in results:
+        log(log_file, log_row)
+        if name_errors:
+            try:
+                save_name_errors(*name_errors)
+            except (OSError, UnicodeError) as error:
+                print(f"Could not save the list of names for staff review to {name_errors[0]}: {error}")
+        if log_row[2] == "Complete":
+            aips_transformed += 1
+        else:
+            aips_errors += 1
+    if executor:
+        executor.shutdown()
+
+    # Closes the log.
+    log_file.close()
+
+    # Prints summary information about the script's success.
+    script_end = datetime.datetime.today()
+    print(f"\nScript completed at {script_end}")
+    print(f"Time to complete: {script_end - script_start}")
+    print(f"{aips_transformed + aips_errors} AIPs were processed.")
+    print(f"{aips_transformed} AIPs were successfully transformed and {aips_errors} AIPs had errors.")
@@ -5,18 +5,26 @@
 #   aips_directory is the folder with the AIPs to be uploaded
 #   partner_tools is the folder with the APTrust Partner Tools
 
+import concurrent.futures
 import csv
 import datetime
 import os
 import subprocess
 import sys
 
+# Number of AIPs to validate at the same time and number of AIPs to upload at the same time, from the optional
+# APTRUST_VALIDATE_THREADS and APTRUST_UPLOAD_THREADS environment variables. If they are not set (1), one AIP is
+# validated while the previous AIP is uploaded.
+VALIDATE_THREADS = max(int(os.environ.get("APTRUST_VALIDATE_THREADS", 1)), 1)
+UPLOAD_THREADS = max(int(os.environ.get("APTRUST_UPLOAD_THREADS", 1)), 1)
+
 
 def validate_arguments(arguments_list):
     """Verifies the three required arguments were provided for running the script: a path to the APTrust partner
     tools, a path to the AIPs directory, and if the AIPs are to be uploaded to production or demo. If any are missing
-    or not an expected value, prints an error message and quits the script. If they are present, makes the AIPs
-    directory the current directory and calculates additional paths. """
+    or not an expected value, prints an error message and quits the script with exit code 2, which is the usual code for
+    an incorrect command. If they are present, calculates additional paths and then makes the AIPs directory the
+    current directory. """
 
     # The script usage information is used in many error statements.
     script_usage = "Script usage: python path/batch_validate.py aptrust_type path/aips_directory path/partner_tools"
@@ -24,99 +32,185 @@ def validate_arguments(arguments_list):
     # Checks for any missing or extra arguments.
     if len(arguments_list) != 4:
         print(f"The incorrect number of script arguments was provided.\n{script_usage}")
-        exit()
+        sys.exit(2)
 
     # Exits the script if the provided APTrust type is not one of the two expected values, production or demo.
     aptrust_type = arguments_list[1]
     if aptrust_type not in ("production", "demo"):
         print(f'The APTrust type must be "production" or "demo".\n{script_usage}')
-        exit()
+        sys.exit(2)
+
+    # Make paths to specific tools and files with the provided path to the partner tools.
+    # Exits the script if the partner tools folder is not a directory or any of the tools and files are not a file,
+    # which takes one check of each path, the same as testing if it exists.
+    # The paths are made absolute before the current directory is changed, so a relative path still works.
+    tools_path = os.path.abspath(arguments_list[3])
+    apt_validate_path = os.path.join(tools_path, "apt_validate.exe")
+    apt_upload_path = os.path.join(tools_path, "apt_upload.exe")
+    config_validate_path = os.path.join(tools_path, "aptrust_bag_validation_config.json")
+    credentials_path = os.path.join(tools_path, f"{aptrust_type}.conf")
 
-    # Makes the provided path to the AIPs directory the current directory.
+    if not os.path.isdir(tools_path):
+        print(f"{tools_path} is incorrect.\n{script_usage}")
+        sys.exit(2)
+    for path in (apt_validate_path, apt_upload_path, config_validate_path, credentials_path):
+        if not os.path.isfile(path):
+            print(f"{path} is incorrect.\n{script_usage}")
+            sys.exit(2)
+
+    # Makes the provided path to the AIPs directory the current directory. This is done last, once all the other
+    # arguments are known to be correct, so the current directory is not changed if the script quits with an error.
     # Exits the script if it does not exist or it is a file instead of a directory.
     aips_directory = arguments_list[2]
     try:
         os.chdir(aips_directory)
     except (FileNotFoundError, NotADirectoryError):
         print(f"The AIPs directory path is incorrect.\n{script_usage}")
-        exit()
+        sys.exit(2)
 
-    # Make paths to specific tools and files with the provided path to the partner tools.
-    # Exits the script if any do not exist.
-    tools_path = arguments_list[3]
-    apt_validate_path = os.path.join(tools_path, "apt_validate.exe")
-    apt_upload_path = os.path.join(tools_path, "apt_upload.exe")
-    config_validate_path = os.path.join(tools_path, "aptrust_bag_validation_config.json")
-    credentials_path = os.path.join(tools_path, f"{aptrust_type}.conf")
+    return aptrust_type, apt_validate_path, apt_upload_path, config_validate_path, credentials_path
 
-    for path in (tools_path, apt_validate_path, apt_upload_path, config_validate_path, credentials_path):
-        if not os.path.exists(path):
-            print(f"{path} is incorrect.\n{script_usage}")
-            exit()
 
-    return apt_validate_path, apt_upload_path, config_validate_path, credentials_path
+def log(log_file, log_row):
+    """Add a row of text to the upload log for later staff review, using the log file that stays open while the
+    script runs."""
+
+    log_writer = csv.writer(log_file)
+    log_writer.writerow(log_row)
+
+
+def previous_uploads(aptrust_type):
+    """Reads the upload log from earlier batches, if there is one, and returns a dictionary with the name of each AIP
+    that was uploaded to the same APTrust type (production or demo) without an error and the date it was uploaded.
+    Rows from before the APTrust type was added to the log do not have it, so those AIPs are treated as not uploaded.
+    If an AIP was uploaded more than once, the most recent date is kept, since the log is in the order the AIPs were
+    uploaded. If the upload date is not in the format the script saves (for example, the log was saved in a
+    spreadsheet program, which changes the dates), the AIP is treated as not uploaded, so it is uploaded again instead
+    of being skipped by mistake. """
+
+    uploads = {}
+    try:
+        with open("aptrust_upload_log.csv", newline="") as previous_log:
+            for row in csv.reader(previous_log):
+                if len(row) == 8 and row[4] == "Upload Complete" and row[7] == aptrust_type:
+                    try:
+                        uploads[row[0]] = datetime.datetime.fromisoformat(row[5])
+                    except ValueError:
+                        uploads.pop(row[0], None)
+    except FileNotFoundError:
+        pass
+    return uploads
+
+
+def validate_aip(apt_validate, config_validate, aip):
+    """Validates the AIP using the Partner Tool apt_validate and returns the result and when validation finished.
+    The tool is run directly, without starting a shell, and the AIP path is given as its own argument, so it does not
+    need quotes. Only the tool's output (stdout) is kept for the log if there is an error; anything it writes to
+    stderr is not used and is discarded. """
+
+    # Prints the current AIP to show the script's progress.
+    print("Starting on:", aip.name)
+
+    result = subprocess.run([apt_validate, f"--config={config_validate}", aip.path],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    # The date is formatted for the log to the second, since the microseconds are not useful for staff review.
+    return result, datetime.datetime.now().isoformat(sep=" ", timespec="seconds")
 
 
-def log(log_row):
-    """Add a row of text to the upload log for later staff review."""
+def upload_aip(apt_upload, credentials, aip):
+    """Uploads the AIP using the Partner Tool apt_upload, run the same way as apt_validate, and returns the result
+    and when the upload finished. """
 
-    with open("aptrust_upload_log.csv", "a", newline="") as log_file:
-        log_writer = csv.writer(log_file)
-        log_writer.writerow(log_row)
+    result = subprocess.run([apt_upload, f"--config={credentials}", f"--key={aip.name}", aip.path],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return result, datetime.datetime.now().isoformat(sep=" ", timespec="seconds")
 
 
 # Validates the script arguments and quits the script if there are any errors.
 # Otherwise, changes the current directory to the AIPs directory the current directory, and gets tool and file paths.
-apt_validate, apt_upload, config_validate, credentials = validate_arguments(sys.argv)
+aptrust_type, apt_validate, apt_upload, config_validate, credentials = validate_arguments(sys.argv)
 
 # Start tracking counts for summarizing script results.
-total_aips = 0
 validation_errors = 0
 upload_errors = 0
 
-# Starts a log, if it doesn't already exist from uploading a previous batch of AIPs.
-if not os.path.exists("aptrust_upload_log.csv"):
-    log(["AIP", "Validation", "Validation Date", "Validation Errors", "Upload", "Upload Date", "Upload Errors"])
-
-# Validate each AIP and upload it to APTrust if it is valid.
-for item in os.listdir("."):
-
-    # Skips anything in the AIPs directory that is not an AIP (tar file), like bag directories or log files.
-    if not item.endswith(".tar"):
-        continue
-
-    # Prints the current AIP to show the script's progress and updated total AIPs counter.
-    print("Starting on:", item)
-    total_aips += 1
-
-    # Validates the AIP using the Partner Tool apt_validate.
-    result = subprocess.run(f'{apt_validate} --config={config_validate} "{os.path.join(os.getcwd(), item)}"',
-                            capture_output=True, shell=True)
-
-    # If the AIP is valid, starts a list to be used for the log once the upload result is obtained.
-    # Otherwise, does not upload. Adds this AIP to the log, updates the error counter, and starts on the next AIP.
-    if result.returncode == 0:
-        to_log = [item, "Valid", datetime.datetime.today(), "n/a"]
-    else:
-        log([item, f"Not Valid: {result.returncode}", datetime.datetime.today(),
-             result.stdout.decode('UTF-8').replace("\n", "; "), "n/a", "n/a", "n/a"])
-        validation_errors += 1
-        continue
-
-    # Run apt_load.
-    result = subprocess.run(f'{apt_upload} --config={credentials} --key="{item}" "{os.path.join(os.getcwd(), item)}"',
-                            capture_output=True, shell=True)
-
-    # Adds this AIP to the log. If there was an error, updates the error counter.
-    if result.returncode == 0:
-        to_log.extend(["Upload Complete", datetime.datetime.today(), "n/a"])
-    else:
-        to_log.extend([f"Upload Error: {result.returncode}", datetime.datetime.today(),
-                       result.stdout.decode('UTF-8').replace("\n", "; ")])
-        upload_errors += 1
-    log(to_log)
+# Gets the AIPs that were already uploaded to this APTrust type in an earlier batch, which is read before the log is
+# opened to add to it. AIPs uploaded to demo are not skipped when uploading to production, or the other way around.
+uploaded = previous_uploads(aptrust_type)
+
+# Opens the log once for use throughout the script, instead of opening and closing it for every row.
+# It is line buffered so each row is saved as soon as it is written, even if the script stops unexpectedly.
+# If the log doesn't exist from uploading a previous batch of AIPs (it is empty), adds a header row.
+log_file = open("aptrust_upload_log.csv", "a", newline="", buffering=1)
+if log_file.tell() == 0:
+    log(log_file, ["AIP", "Validation", "Validation Date", "Validation Errors",
+                   "Upload", "Upload Date", "Upload Errors", "APTrust Type"])
+
+# Gets each AIP in the AIPs directory, skipping anything that is not an AIP (tar file), like bag directories or logs,
+# based on the file extension and the file type from scandir, which does not need another system call for each item.
+# Scanning the full path of the AIPs directory gives the full path of each AIP for the Partner Tools.
+with os.scandir(os.getcwd()) as items:
+    aips = [item for item in items if item.name.endswith(".tar") and item.is_file(follow_symlinks=False)]
+
+# Skips any AIP that the log shows was already uploaded to this APTrust type, so rerunning the script after some AIPs
+# had errors does not validate and upload the rest of the batch again. An AIP is only skipped if it has not been
+# changed (for example, by transforming it again) since it was uploaded. The log has the upload date to the second,
+# so the AIP's last modified date is compared to the second as well.
+already_uploaded = {aip.name for aip in aips if aip.name in uploaded and
+                    datetime.datetime.fromtimestamp(int(aip.stat().st_mtime)) <= uploaded[aip.name]}
+for aip_name in sorted(already_uploaded):
+    print("Skipping, already uploaded:", aip_name)
+aips = [aip for aip in aips if aip.name not in already_uploaded]
+total_aips = len(aips)
+
+# Validates each AIP and uploads it to APTrust if it is valid. Validating and uploading are done in separate threads,
+# so the next AIP is validated (which mostly uses the processor and disk) while the previous AIP is uploaded (which
+# mostly uses the network). As soon as an AIP is validated, its upload is started or its validation error is logged,
+# and as soon as an AIP is uploaded, its row is added to the log.
+validate_executor = concurrent.futures.ThreadPoolExecutor(max_workers=VALIDATE_THREADS)
+upload_executor = concurrent.futures.ThreadPoolExecutor(max_workers=UPLOAD_THREADS)
+validations = {validate_executor.submit(validate_aip, apt_validate, config_validate, aip): aip for aip in aips}
+uploads = {}
+running = set(validations)
+while running:
+    finished, running = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+    for future in finished:
+
+        # An AIP finished validation. If it is valid, starts the upload and a list to be used for the log once the
+        # upload result is obtained. Otherwise, does not upload. Adds this AIP to the log and updates the error
+        # counter.
+        if future in validations:
+            aip = validations[future]
+            result, validation_date = future.result()
+            if result.returncode == 0:
+                upload_future = upload_executor.submit(upload_aip, apt_upload, credentials, aip)
+                uploads[upload_future] = [aip.name, "Valid", validation_date, "n/a"]
+                running.add(upload_future)
+            else:
+                log(log_file, [aip.name, f"Not Valid: {result.returncode}", validation_date,
+                               result.stdout.decode('UTF-8').replace("\n", "; "), "n/a", "n/a", "n/a", aptrust_type])
+                validation_errors += 1
+
+        # An AIP finished uploading. Adds this AIP to the log. If there was an error, updates the error counter.
+        else:
+            to_log = uploads.pop(future)
+            result, upload_date = future.result()
+            if result.returncode == 0:
+                to_log.extend(["Upload Complete", upload_date, "n/a", aptrust_type])
+            else:
+                to_log.extend([f"Upload Error: {result.returncode}", upload_date,
+                               result.stdout.decode('UTF-8').replace("\n", "; "), aptrust_type])
+                upload_errors += 1
+            log(log_file, to_log)
+validate_executor.shutdown()
+upload_executor.shutdown()
+
+# Closes the log now that all the AIPs are done.
+log_file.close()
 
 # Print a summary of the script results.
 print(f"\nScript is complete, with {total_aips} AIPs processed.")
+print(len(already_uploaded), "AIPs were already uploaded and were skipped.")
 print(validation_errors, "AIPs had validation errors.")
 print(upload_errors, "AIPs had upload errors.")